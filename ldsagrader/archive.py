@@ -0,0 +1,162 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+from urllib.parse import quote
+
+import nbformat
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# Smaller cells are kept in the notebook manifest, a file each costs more
+# than deduplicating them saves
+INLINE_SIZE = 256
+
+
+def compress(data):
+    if zstandard is not None:
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data, mtime=0)
+
+
+def decompress(data):
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError("Archive object is zstd compressed, install zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def dumps(value):
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def serialize(notebook):
+    """
+    Serialize a notebook the way nbformat.write does
+    """
+    data = nbformat.writes(notebook)
+    if not data.endswith("\n"):
+        data += "\n"
+    return data.encode("utf-8")
+
+
+class Archive:
+    """
+    Content addressed archive of graded notebooks
+
+    Every cell is stored once as a compressed object named by its sha256, so
+    the locked and instructor cells shared by all submissions of a unit
+    cost nothing after the first one. A notebook is a manifest object with
+    its metadata, the list of cell objects (small cells inline) and their
+    execution timings, and each name keeps a log of the manifests archived
+    under it. Notebooks that would not be rebuilt byte for byte from their
+    cells are stored whole.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, "objects", digest[:2], digest[2:])
+
+    def _ref_path(self, name):
+        return os.path.join(self.directory, "refs", quote(name, safe=""))
+
+    def _store(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            return digest
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(compress(data))
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return digest
+
+    def _load(self, digest):
+        with open(self._object_path(digest), "rb") as fp:
+            return decompress(fp.read())
+
+    def _pack_cell(self, cell):
+        cell = dict(cell, metadata=dict(cell.metadata))
+        # Run timestamps differ on every execution, keep them out of the object
+        entry = {}
+        if "execution" in cell["metadata"]:
+            entry["execution"] = cell["metadata"].pop("execution")
+
+        data = dumps(cell)
+        if len(data) < INLINE_SIZE:
+            entry["inline"] = cell
+        else:
+            entry["object"] = self._store(data)
+        return entry
+
+    def _unpack_cell(self, entry):
+        if "object" in entry:
+            cell = json.loads(self._load(entry["object"]))
+        else:
+            cell = entry["inline"]
+        if "execution" in entry:
+            metadata = dict(cell["metadata"], execution=entry["execution"])
+            cell = dict(cell, metadata=metadata)
+        return cell
+
+    def _rebuild(self, manifest):
+        if "raw" in manifest:
+            return self._load(manifest["raw"])
+
+        notebook = dict(manifest)
+        notebook["cells"] = [self._unpack_cell(entry) for entry in manifest["cells"]]
+        return serialize(nbformat.from_dict(notebook))
+
+    def put(self, name, data):
+        """
+        Archive the notebook file contents `data` under name, returns the
+        manifest digest
+        """
+        notebook = nbformat.reads(data.decode("utf-8"), as_version=nbformat.NO_CONVERT)
+        manifest = dict(notebook)
+        manifest["cells"] = [self._pack_cell(cell) for cell in notebook.cells]
+        if self._rebuild(manifest) != data:
+            manifest = {"raw": self._store(data)}
+
+        digest = self._store(dumps(manifest))
+        os.makedirs(os.path.dirname(self._ref_path(name)), exist_ok=True)
+        with open(self._ref_path(name), "a") as fp:
+            fp.write(f"{time.time():.0f} {digest}\n")
+        return digest
+
+    def history(self, name):
+        """
+        (timestamp, manifest digest) of every notebook archived under name
+        """
+        try:
+            with open(self._ref_path(name)) as fp:
+                entries = [line.split() for line in fp if line.strip()]
+        except FileNotFoundError:
+            raise RuntimeError(f"Nothing archived as {name}")
+
+        return [(int(timestamp), digest) for timestamp, digest in entries]
+
+    def get(self, name, digest=None):
+        """
+        Rebuild the notebook file contents archived under name, the latest
+        one unless a manifest digest is given
+        """
+        if digest is None:
+            _, digest = self.history(name)[-1]
+        return self._rebuild(json.loads(self._load(digest)))
@@ -0,0 +1,85 @@
+import hashlib
+import marshal
+import os
+import tempfile
+
+import nbformat
+
+
+def plain(value):
+    """
+    NotebookNode to the builtin types marshal supports
+    """
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    return value
+
+
+class NotebookCache:
+    """
+    Cache of parsed and validated notebooks keyed by path, mtime and size so
+    a changed file is never served stale. Keeps the `max_entries` most
+    recently used notebooks.
+
+    Entries are marshal dumps of the plain notebook dict, unlike pickle
+    loading them can't run code.
+    """
+
+    def __init__(self, directory, max_entries=64):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def _entry(self, path):
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}\0{stat.st_mtime_ns}\0{stat.st_size}"
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.marshal")
+
+    def read(self, path):
+        entry = self._entry(path)
+        try:
+            with open(entry, "rb") as fp:
+                data = marshal.load(fp)
+            if isinstance(data, dict):
+                os.utime(entry)
+                return nbformat.from_dict(data)
+        except (OSError, ValueError, EOFError, TypeError):
+            pass
+
+        notebook = nbformat.read(path, as_version=nbformat.NO_CONVERT)
+        try:
+            self._write(entry, notebook)
+        except OSError as exc:
+            print(f"Notebook cache write failed: {exc}")
+        return notebook
+
+    def _write(self, entry, notebook):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                marshal.dump(plain(notebook), fp)
+            os.replace(tmp, entry)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self._prune()
+
+    def _prune(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".marshal"):
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.stat(path).st_mtime, path))
+                except FileNotFoundError:
+                    pass
+
+        entries.sort(reverse=True)
+        for _, path in entries[self.max_entries:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
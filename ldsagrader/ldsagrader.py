@@ -1,14 +1,24 @@
+import contextlib
+import glob
 import io
+import json
 import os
+import socket
 import sys
+import tempfile
+import time
 from typing import Dict
+from urllib.parse import urlsplit
 
 import click
 import nbformat
 import requests
 from requests import HTTPError
 
-from . import utils
+from . import loadtest, sharding, utils
+from .archive import Archive
+from .cache import NotebookCache
+from .progress import ProgressReporter
 
 
 config = {
@@ -16,9 +26,56 @@ config = {
     "grading_url": os.environ.get("LDSA_GRADING_URL"),
     "checksum_url": os.environ.get("LDSA_CHECKSUM_URL"),
     "hackathon_url": os.environ.get("LDSA_HACKATHON_URL"),
+    # Empty to disable the parsed exercise notebook cache
+    "notebook_cache": os.environ.get(
+        "LDSA_NOTEBOOK_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "ldsagrader", "notebooks"),
+    ),
+    "notebook_cache_size": int(os.environ.get("LDSA_NOTEBOOK_CACHE_SIZE", 64)),
+    "archive": os.environ.get("LDSA_ARCHIVE"),
 }
 
 
+def notebook_cache():
+    if config["notebook_cache"]:
+        return NotebookCache(config["notebook_cache"], config["notebook_cache_size"])
+
+
+def read_exercise_nb(notebook_path):
+    """
+    Read an instructor exercise notebook, through the cache when enabled
+    """
+    cache = notebook_cache()
+    if cache:
+        return cache.read(notebook_path)
+    return nbformat.read(notebook_path, as_version=nbformat.NO_CONVERT)
+
+
+# noinspection PyBroadException
+def archive_notebook(archive_dir, name, fp):
+    """
+    Keep a local copy of a graded notebook, failing to do so doesn't fail grading
+    """
+    print("Archiving notebook...")
+    try:
+        Archive(archive_dir).put(name, fp.getvalue().encode("utf-8"))
+    except Exception as exc:
+        print(f"Archiving notebook failed: {exc}")
+
+
+def print_memory_profile(notebook, budget=None):
+    """
+    Print per cell kernel memory, warning on cells with a peak over budget (MB)
+    """
+    for cell in utils.memory_profile(notebook):
+        peak = cell["peak_rss"] / 2 ** 20
+        delta = cell["delta_rss"] / 2 ** 20
+        name = cell["grade_id"] or f"cell {cell['cell_index']}"
+        print(f"Memory {name}: peak {peak:.1f} MB, delta {delta:+.1f} MB")
+        if budget and peak > budget:
+            print(f"Warning: {name} peak memory over budget of {budget} MB")
+
+
 @click.group()
 def main():
     pass
@@ -31,13 +88,34 @@ def checksum():
 
 # noinspection PyShadowingNames
 @checksum.command("digest")
-@click.argument("notebook", type=click.Path(exists=True))
-def checksum_digest(notebook):
+@click.argument("notebooks", nargs=-1, required=True)
+@click.option("--json", "as_json", is_flag=True)
+@click.option("--workers", type=int, default=None)
+def checksum_digest(notebooks, as_json, workers):
     """
-    Output grading cell hashes
+    Output grading cell hashes of one or more notebooks (paths or globs)
     """
-    notebook = nbformat.read(notebook, as_version=nbformat.NO_CONVERT)
-    print(utils.calculate_checksum(notebook))
+    paths = []
+    for pattern in notebooks:
+        # Existing paths are taken as is, they may contain glob characters
+        if os.path.exists(pattern):
+            matches = [pattern]
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            raise click.BadParameter(f"No notebook matches {pattern}")
+        paths.extend(path for path in matches if path not in paths)
+
+    checksums = utils.calculate_file_checksums(paths, workers)
+    if as_json:
+        print(json.dumps(checksums, indent=2))
+
+    elif len(checksums) == 1:
+        print(checksums[paths[0]])
+
+    else:
+        for path, checksum in checksums.items():
+            print(f"{checksum}  {path}")
 
 
 # noinspection PyShadowingNames
@@ -138,14 +216,17 @@ def notebook_grade(notebook, checksum, timeout) -> Dict[str, float]:
 @click.argument("notebook", type=click.Path(exists=True))
 @click.option("--timeout", type=int, default=None)
 @click.option("--output", type=str)
-def notebook_execute(notebook, timeout, output):
+@click.option("--profile-memory", is_flag=True)
+def notebook_execute(notebook, timeout, output, profile_memory):
     """
     Execute notebook and output results to file
     """
     notebook_path = notebook
     notebook = nbformat.read(notebook_path, as_version=nbformat.NO_CONVERT)
     print("Executing notebook...")
-    notebook = utils.execute(notebook, timeout)
+    notebook = utils.execute(notebook, timeout, profile_memory=profile_memory)
+    if profile_memory:
+        print_memory_profile(notebook)
     print("Writing notebook...")
     if output:
         notebook_path = output
@@ -241,12 +322,7 @@ def academy_grade(codename, username, timeout):
             sys.exit(1)
 
         print("Executing notebook...")
-        if head:
-            cwd = os.getcwd()
-            os.chdir(head)
-        notebook = utils.execute(notebook, timeout)
-        if head:
-            os.chdir(cwd)
+        notebook = utils.execute(notebook, timeout, cwd=head)
 
         if not utils.is_valid(notebook, checksum):
             print("Checksum mismatch! (b)")
@@ -291,6 +367,9 @@ def academy_grade(codename, username, timeout):
             print(response.content)
             raise
 
+        if config["archive"]:
+            archive_notebook(config["archive"], f"{codename}/{username}", fp)
+
     except Exception as exc:
         response = requests.put(
             config["grading_url"].format(username=username, codename=codename),
@@ -311,13 +390,15 @@ def academy_grade(codename, username, timeout):
 @click.option("--timeout", type=int, default=None)
 @click.option("--codename", type=str, required=True)
 @click.option("--checksum", is_flag=True)
-def academy_validate(codename, timeout, checksum):
+@click.option("--profile-memory", is_flag=True)
+@click.option("--memory-budget", type=float, default=None, help="MB")
+def academy_validate(codename, timeout, checksum, profile_memory, memory_budget):
     """
     Validate notebook hashes and grade
     """
     notebook_path = utils.find_exercise_nb(codename)
     head, _ = os.path.split(notebook_path)
-    notebook = nbformat.read(notebook_path, as_version=nbformat.NO_CONVERT)
+    notebook = read_exercise_nb(notebook_path)
 
     if checksum:
         print("Fetching checksum...")
@@ -338,12 +419,15 @@ def academy_validate(codename, timeout, checksum):
             sys.exit(1)
 
     print("Executing notebook...")
-    if head:
-        cwd = os.getcwd()
-        os.chdir(head)
-    notebook = utils.execute(notebook, timeout, allow_errors=False)
-    if head:
-        os.chdir(cwd)
+    notebook = utils.execute(
+        notebook,
+        timeout,
+        allow_errors=False,
+        cwd=head,
+        profile_memory=profile_memory or bool(memory_budget),
+    )
+    if profile_memory or memory_budget:
+        print_memory_profile(notebook, memory_budget)
 
     if checksum:
         if not utils.is_valid(notebook, db_checksum):
@@ -370,26 +454,58 @@ def academy_validate(codename, timeout, checksum):
 
 # noinspection PyShadowingNames
 @academy.command("update")
-@click.option("--codename", type=str, required=True)
-def academy_update(codename):
+@click.option("--codename", type=str)
+@click.option("--all", "all_units", is_flag=True)
+@click.option("--workers", type=int, default=None)
+def academy_update(codename, all_units, workers):
     """
     Update notebook metadata in db
     """
-    notebook_path = utils.find_exercise_nb(codename)
-    notebook = nbformat.read(notebook_path, as_version=nbformat.NO_CONVERT)
+    if bool(codename) == all_units:
+        raise click.UsageError("Use either --codename or --all")
 
-    print("Posting checksums...")
-    checksum = utils.calculate_checksum(notebook)
-    response = requests.patch(
-        config["checksum_url"].format(codename=codename),
-        headers={"Authorization": f"Token {config['token']}"},
-        json={"checksum": checksum},
-    )
-    try:
-        response.raise_for_status()
-    except HTTPError:
-        print(response.content)
-        raise
+    if all_units:
+        units = utils.find_exercise_nbs()
+    else:
+        units = {codename: utils.find_exercise_nb(codename)}
+
+    print("Calculating checksums...")
+    checksums = utils.calculate_file_checksums(
+        list(units.values()), workers, notebook_cache())
+
+    failed = []
+    with requests.Session() as session:
+        session.headers["Authorization"] = f"Token {config['token']}"
+
+        for codename, notebook_path in units.items():
+            checksum = checksums[notebook_path]
+            url = config["checksum_url"].format(codename=codename)
+
+            if all_units:
+                response = session.get(url)
+                try:
+                    response.raise_for_status()
+                except HTTPError:
+                    print(f"Fetching checksum ({codename}) failed")
+                    print(response.content)
+                    failed.append(codename)
+                    continue
+                if response.json()["checksum"] == checksum:
+                    continue
+
+            print(f"Posting checksums ({codename})...")
+            response = session.patch(url, json={"checksum": checksum})
+            try:
+                response.raise_for_status()
+            except HTTPError:
+                print(response.content)
+                if not all_units:
+                    raise
+                failed.append(codename)
+
+    if failed:
+        print(f"Failed to update: {', '.join(failed)}")
+        sys.exit(1)
 
 
 # noinspection PyShadowingNames
@@ -400,7 +516,7 @@ def academy_clear(codename):
     Replace exercise notebook with student version
     """
     notebook_path = utils.find_exercise_nb(codename)
-    notebook = nbformat.read(notebook_path, as_version=nbformat.NO_CONVERT)
+    notebook = read_exercise_nb(notebook_path)
     print("Clearing notebook...")
     notebook = utils.clear(notebook)
     print("Writing notebook...")
@@ -410,21 +526,20 @@ def academy_clear(codename):
 @academy.command("execute")
 @click.option("--timeout", type=int, default=None)
 @click.option("--codename", type=str, required=True)
-def academy_execute(codename, timeout):
+@click.option("--profile-memory", is_flag=True)
+def academy_execute(codename, timeout, profile_memory):
     """
     Run
     """
     notebook_path = utils.find_exercise_nb(codename)
     head, _ = os.path.split(notebook_path)
-    notebook = nbformat.read(notebook_path, as_version=nbformat.NO_CONVERT)
+    notebook = read_exercise_nb(notebook_path)
 
     print("Executing notebook...")
-    if head:
-        cwd = os.getcwd()
-        os.chdir(head)
-    notebook = utils.execute(notebook, timeout)
-    if head:
-        os.chdir(cwd)
+    notebook = utils.execute(
+        notebook, timeout, cwd=head, profile_memory=profile_memory)
+    if profile_memory:
+        print_memory_profile(notebook)
 
     print("Grading notebook...")
     total_score, max_score = utils.grade(notebook)
@@ -443,15 +558,10 @@ def verify(codename, timeout):
     """
     notebook_path = utils.find_exercise_nb(codename)
     head, _ = os.path.split(notebook_path)
-    notebook = nbformat.read(notebook_path, as_version=nbformat.NO_CONVERT)
+    notebook = read_exercise_nb(notebook_path)
 
     print("Executing notebook...")
-    if head:
-        cwd = os.getcwd()
-        os.chdir(head)
-    notebook = utils.execute(notebook, timeout, allow_errors=False)
-    if head:
-        os.chdir(cwd)
+    notebook = utils.execute(notebook, timeout, allow_errors=False, cwd=head)
 
     print("Clearing notebook...")
     utils.clear(notebook)
@@ -498,16 +608,21 @@ def portal():
     pass
 
 
-# noinspection PyShadowingNames,PyBroadException
-@portal.command("grade")
-@click.option("--timeout", type=int, default=None)
-@click.option("--notebook_path", type=str, required=True)
-@click.option("--grading_url", type=str, required=True)
-@click.option("--checksum_url", type=str, required=True)
-@click.option("--token", type=str, required=True)
-def portal_grade(notebook_path, grading_url, checksum_url, token=None, timeout=None):
+# noinspection PyBroadException
+def grade_portal_submission(
+    notebook_path,
+    grading_url,
+    checksum_url,
+    token,
+    timeout=None,
+    progress_interval=5,
+    archive_dir=None,
+    archive_name=None,
+):
     """
-    Update notebook metadata in db
+    Grade a submission posting the results to the portal, returns False on
+    checksum mismatch. The graded notebook is archived as archive_name,
+    by default the grading url path.
     """
     print("Starting")
     try:
@@ -556,15 +671,28 @@ def portal_grade(notebook_path, grading_url, checksum_url, token=None, timeout=N
             except HTTPError:
                 print(response.content)
                 raise
-            sys.exit(1)
+            return False
 
         print("Executing notebook...")
-        if head:
-            cwd = os.getcwd()
-            os.chdir(head)
-        notebook = utils.execute(notebook, timeout)
-        if head:
-            os.chdir(cwd)
+        status = "graded"
+        message = ""
+        progress = None
+        if progress_interval:
+            progress = ProgressReporter(
+                grading_url, token, len(notebook.cells), progress_interval)
+        try:
+            with progress or contextlib.nullcontext():
+                notebook = utils.execute(
+                    notebook,
+                    timeout,
+                    cwd=head,
+                    cell_callback=progress and progress.cell_executed,
+                )
+        except utils.ExecutionInterrupted as exc:
+            print(f"Execution interrupted: {exc}")
+            notebook = exc.notebook
+            status = "graded-partial"
+            message = f"{exc.reason}, {exc.cell_name} and later cells scored zero"
 
         if not utils.is_valid(notebook, checksum):
             print("Checksum mismatch! (b)")
@@ -580,7 +708,7 @@ def portal_grade(notebook_path, grading_url, checksum_url, token=None, timeout=N
             except HTTPError:
                 print(response.content)
                 raise
-            sys.exit(1)
+            return False
 
         print("Grading notebook...")
         total_score, max_score = utils.grade(notebook)
@@ -594,8 +722,9 @@ def portal_grade(notebook_path, grading_url, checksum_url, token=None, timeout=N
             grading_url,
             headers={"Authorization": f"Token {token}"},
             data={
-                "status": "graded",
+                "status": status,
                 "score": total_score,
+                "message": message,
             },
             files={"notebook": ("notebook.ipynb", fp, "application/x-ipynb+json")},
         )
@@ -605,6 +734,12 @@ def portal_grade(notebook_path, grading_url, checksum_url, token=None, timeout=N
             print(response.content)
             raise
 
+        if archive_dir:
+            name = archive_name or urlsplit(grading_url).path.strip("/")
+            archive_notebook(archive_dir, name, fp)
+
+        return True
+
     except Exception as exc:
         response = requests.patch(
             grading_url,
@@ -618,6 +753,133 @@ def portal_grade(notebook_path, grading_url, checksum_url, token=None, timeout=N
         raise
 
 
+# noinspection PyShadowingNames
+@portal.command("grade")
+@click.option("--timeout", type=int, default=None)
+@click.option("--notebook_path", type=str, required=True)
+@click.option("--grading_url", type=str, required=True)
+@click.option("--checksum_url", type=str, required=True)
+@click.option("--token", type=str, required=True)
+@click.option("--progress-interval", type=float, default=5, help="0 to disable")
+@click.option("--archive", "archive_dir", type=str, default=lambda: config["archive"])
+def portal_grade(
+    notebook_path, grading_url, checksum_url, token=None, timeout=None,
+    progress_interval=5, archive_dir=None,
+):
+    """
+    Update notebook metadata in db
+    """
+    if not grade_portal_submission(
+        notebook_path,
+        grading_url,
+        checksum_url,
+        token,
+        timeout,
+        progress_interval,
+        archive_dir,
+    ):
+        sys.exit(1)
+
+
+# noinspection PyShadowingNames,PyBroadException
+@portal.command("grade-batch")
+@click.option("--timeout", type=int, default=None)
+@click.option(
+    "--submissions", type=click.Path(exists=True, file_okay=False), required=True
+)
+@click.option("--token", type=str, required=True)
+@click.option("--progress-interval", type=float, default=5, help="0 to disable")
+@click.option("--archive", "archive_dir", type=str, default=lambda: config["archive"])
+@click.option("--shard", type=str, default=None, help="i/n, 0 <= i < n")
+@click.option("--lease-dir", type=click.Path(file_okay=False), default=None)
+@click.option("--lease-ttl", type=int, default=600)
+@click.option(
+    "--node", type=str, default=lambda: f"{socket.gethostname()}-{os.getpid()}"
+)
+def portal_grade_batch(
+    submissions,
+    token,
+    timeout,
+    progress_interval,
+    archive_dir,
+    shard,
+    lease_dir,
+    lease_ttl,
+    node,
+):
+    """
+    Grade the submissions described by the json files in a directory
+
+    Each json file has the username, codename, notebook_path (relative to
+    the json file), grading_url and checksum_url of a submission.
+    """
+    jobs = []
+    for job_path in sorted(glob.glob(os.path.join(submissions, "*.json"))):
+        with open(job_path) as fp:
+            job = json.load(fp)
+        # Leases are per submission file, a student can have several
+        job["key"] = os.path.splitext(os.path.basename(job_path))[0]
+        job["name"] = f"{job['username']}/{job['codename']}"
+        job["notebook_path"] = os.path.join(
+            os.path.dirname(job_path), job["notebook_path"])
+        jobs.append(job)
+
+    own = jobs
+    if shard:
+        try:
+            index, count = sharding.parse_shard(shard)
+        except ValueError as exc:
+            raise click.BadParameter(str(exc), param_hint="--shard")
+        own = [job for job in jobs if sharding.shard_of(job["name"], count) == index]
+
+    failed = []
+
+    def grade(job):
+        print(f"Grading {job['name']} ({job['key']})...")
+        try:
+            grade_portal_submission(
+                job["notebook_path"],
+                job["grading_url"],
+                job["checksum_url"],
+                token,
+                timeout,
+                progress_interval,
+                archive_dir,
+                job["name"],
+            )
+        except Exception as exc:
+            print(f"Grading {job['name']} ({job['key']}) failed: {exc}")
+            failed.append(job)
+            return False
+        return True
+
+    if lease_dir:
+        # Own shard first, then steal what other nodes have not picked up yet
+        pending = own + [job for job in jobs if job not in own]
+        with sharding.LeaseDirectory(lease_dir, node, lease_ttl) as leases:
+            while pending:
+                for job in pending:
+                    if leases.acquire(job["key"]):
+                        # Failed jobs are left for other nodes or a later run
+                        leases.release(job["key"], done=grade(job))
+
+                pending = [
+                    job for job in pending
+                    if job not in failed and not leases.is_done(job["key"])
+                ]
+                if pending:
+                    # Leased by other nodes, wait for them to finish or expire
+                    time.sleep(lease_ttl / 10)
+
+    else:
+        for job in own:
+            grade(job)
+
+    if failed:
+        print(f"Failed to grade: {', '.join(job['key'] for job in failed)}")
+        sys.exit(1)
+
+
 # noinspection PyShadowingNames
 @portal.command("validate")
 @click.option("--notebook_path", type=str, required=True)
@@ -631,12 +893,7 @@ def portal_validate(notebook_path, timeout, allow_hidden_tests):
     notebook = nbformat.read(notebook_path, as_version=nbformat.NO_CONVERT)
 
     print("Executing notebook...")
-    if head:
-        cwd = os.getcwd()
-        os.chdir(head)
-    notebook = utils.execute(notebook, timeout, allow_errors=False)
-    if head:
-        os.chdir(cwd)
+    notebook = utils.execute(notebook, timeout, allow_errors=False, cwd=head)
 
     print("Grading notebook...")
     total_score, max_score = utils.grade(notebook)
@@ -681,5 +938,103 @@ def portal_update(notebook_path, checksum_url, token):
         raise
 
 
+@main.group()
+def archive():
+    pass
+
+
+# noinspection PyShadowingNames
+@archive.command("put")
+@click.argument("name")
+@click.argument("notebook", type=click.Path(exists=True))
+@click.option("--archive", "archive_dir", type=str, default=lambda: config["archive"])
+def archive_put(name, notebook, archive_dir):
+    """
+    Add a graded notebook to the archive
+    """
+    if not archive_dir:
+        raise click.UsageError("Set --archive or LDSA_ARCHIVE")
+
+    with open(notebook, "rb") as fp:
+        print(Archive(archive_dir).put(name, fp.read()))
+
+
+# noinspection PyShadowingNames
+@archive.command("log")
+@click.argument("name")
+@click.option("--archive", "archive_dir", type=str, default=lambda: config["archive"])
+def archive_log(name, archive_dir):
+    """
+    List the notebooks archived under a name
+    """
+    if not archive_dir:
+        raise click.UsageError("Set --archive or LDSA_ARCHIVE")
+
+    for timestamp, digest in Archive(archive_dir).history(name):
+        print(f"{digest} {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))}")
+
+
+# noinspection PyShadowingNames
+@archive.command("get")
+@click.argument("name")
+@click.option("--digest", type=str, default=None)
+@click.option("--output", type=str)
+@click.option("--archive", "archive_dir", type=str, default=lambda: config["archive"])
+def archive_get(name, digest, output, archive_dir):
+    """
+    Rebuild an archived notebook, the latest one unless a digest is given
+    """
+    if not archive_dir:
+        raise click.UsageError("Set --archive or LDSA_ARCHIVE")
+
+    data = Archive(archive_dir).get(name, digest)
+    if output:
+        with open(output, "wb") as fp:
+            fp.write(data)
+    else:
+        sys.stdout.buffer.write(data)
+
+
+# noinspection PyShadowingNames
+@main.command("loadtest")
+@click.option("--template", type=click.Path(exists=True), required=True)
+@click.option("-n", "--submissions", type=click.IntRange(min=1), default=20)
+@click.option("--concurrency", type=click.IntRange(min=1), default=1)
+@click.option("--tampered", type=click.FloatRange(0, 1), default=0.0)
+@click.option("--failing", type=click.FloatRange(0, 1), default=0.0)
+@click.option("--slow", type=click.FloatRange(0, 1), default=0.0)
+@click.option("--slow-seconds", type=float, default=30)
+@click.option("--timeout", type=int, default=None)
+@click.option("--portal-latency", type=float, default=0.0)
+@click.option("--seed", type=int, default=None)
+def loadtest_run(template, submissions, concurrency, tampered, failing, slow,
+                 slow_seconds, timeout, portal_latency, seed):
+    """
+    Measure portal grade throughput against a local fake portal
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        print("Running load test...")
+        report = loadtest.run(
+            template,
+            submissions,
+            concurrency,
+            tampered=tampered,
+            failing=failing,
+            slow=slow,
+            slow_seconds=slow_seconds,
+            timeout=timeout,
+            portal_latency=portal_latency,
+            directory=directory,
+            seed=seed,
+        )
+
+    print(json.dumps(report, indent=2))
+
+    failing = report["failing"]
+    if failing["below_baseline"] < failing["submissions"]:
+        print("Failing submissions not scored below the baseline")
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     main()
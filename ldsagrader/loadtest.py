@@ -0,0 +1,267 @@
+import collections
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import nbformat
+from nbformat.v4 import new_code_cell
+from nbgrader import utils as nbgrader_utils
+
+from . import utils
+
+
+class FakePortal:
+    """
+    Local stand-in for the portal checksum and grading endpoints used by
+    `portal grade`, records every status and score posted for each
+    submission
+    """
+
+    def __init__(self, checksum, latency=0.0):
+        self.checksum = checksum
+        self.latency = latency
+        self.statuses = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def checksum_url(self):
+        return f"{self.url}/checksum/"
+
+    def grading_url(self, submission_id):
+        return f"{self.url}/grades/{submission_id}/"
+
+    def record(self, submission_id, status, score=None):
+        with self._lock:
+            self.statuses[submission_id].append((status, score))
+
+    def final_status(self, submission_id):
+        """
+        Last (status, score) posted for the submission
+        """
+        with self._lock:
+            statuses = self.statuses.get(submission_id)
+            return statuses[-1] if statuses else (None, None)
+
+    def _handler(self):
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                time.sleep(portal.latency)
+                self._respond({"checksum": portal.checksum})
+
+            def do_PATCH(self):
+                time.sleep(portal.latency)
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("multipart/form-data"):
+                    fields = parse_multipart(content_type, body)
+                else:
+                    fields = json.loads(body)
+
+                submission_id = self.path.strip("/").split("/")[-1]
+                portal.record(
+                    submission_id, fields.get("status"), fields.get("score"))
+                self._respond({})
+
+        return Handler
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def parse_multipart(content_type, body):
+    header = f"Content-Type: {content_type}\r\n\r\n".encode("utf-8")
+    message = BytesParser(policy=HTTP).parsebytes(header + body)
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if part.get_filename() is None:
+            fields[name] = part.get_content()
+    return fields
+
+
+def build_submissions(template, directory, count, tampered, failing, slow,
+                      slow_seconds, seed=None):
+    """
+    Write `count` copies of the template notebook, a fraction of them with
+    a tampered grade cell, failing work or a slow cell, returns a list of
+    (submission id, kind, notebook path)
+
+    Failing submissions raise in every code cell that is not a grade cell,
+    so the tests error while the checksum still matches.
+
+    The rest of the template directory (the unit data files) is copied
+    along, as submissions are executed from the directory they are in.
+    """
+    rng = random.Random(seed)
+    shutil.copytree(
+        os.path.dirname(os.path.abspath(template)), directory, dirs_exist_ok=True)
+    notebook = nbformat.read(template, as_version=nbformat.NO_CONVERT)
+    grade_cells = [i for i, cell in enumerate(notebook.cells)
+                   if nbgrader_utils.is_grade(cell)]
+    work_cells = [i for i, cell in enumerate(notebook.cells)
+                  if cell.cell_type == "code" and i not in grade_cells]
+    if tampered and not grade_cells:
+        raise RuntimeError("Template notebook has no grade cells to tamper with")
+    if failing and not work_cells:
+        raise RuntimeError("Template notebook has no code cells to break")
+
+    kinds = (["tampered"] * round(count * tampered)
+             + ["failing"] * round(count * failing)
+             + ["slow"] * round(count * slow))
+    if len(kinds) > count:
+        raise RuntimeError("Tampered, failing and slow fractions add up over 1")
+    kinds += ["ok"] * (count - len(kinds))
+    rng.shuffle(kinds)
+
+    submissions = []
+    for i, kind in enumerate(kinds):
+        submission = nbformat.from_dict(notebook)
+        if kind == "tampered":
+            cell = submission.cells[rng.choice(grade_cells)]
+            cell.source += "\n# tampered"
+        elif kind == "failing":
+            for index in work_cells:
+                submission.cells[index].source = (
+                    'raise RuntimeError("Load test failure")')
+        elif kind == "slow":
+            submission.cells.insert(
+                0, new_code_cell(f"import time\ntime.sleep({slow_seconds})"))
+
+        submission_id = f"{i:05d}"
+        path = os.path.join(directory, f"{submission_id}.ipynb")
+        nbformat.write(submission, path)
+        submissions.append((submission_id, kind, path))
+
+    return submissions
+
+
+def grade_submission(portal, submission_id, notebook_path, timeout=None):
+    """
+    Run `ldsagrader portal grade` for one submission, returns the exit code
+    and the wall clock latency in seconds
+    """
+    command = [
+        sys.executable, "-m", "ldsagrader.ldsagrader", "portal", "grade",
+        "--notebook_path", notebook_path,
+        "--grading_url", portal.grading_url(submission_id),
+        "--checksum_url", portal.checksum_url(),
+        "--token", "loadtest",
+    ]
+    if timeout:
+        command += ["--timeout", str(timeout)]
+
+    # Keep simulated submissions out of the real archive
+    env = {key: value for key, value in os.environ.items() if key != "LDSA_ARCHIVE"}
+
+    start = time.monotonic()
+    process = subprocess.run(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+    return process.returncode, time.monotonic() - start
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile
+    """
+    values = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+def run(template, count, concurrency, tampered=0.0, failing=0.0, slow=0.0,
+        slow_seconds=30, timeout=None, portal_latency=0.0, directory=".",
+        seed=None):
+    """
+    Grade `count` simulated submissions against a fake portal with
+    `concurrency` graders in parallel, returns the load test report
+    """
+    notebook = nbformat.read(template, as_version=nbformat.NO_CONVERT)
+    portal = FakePortal(utils.calculate_checksum(notebook), portal_latency)
+    submissions = build_submissions(
+        template, directory, count, tampered, failing, slow, slow_seconds, seed)
+
+    portal.start()
+    try:
+        start = time.monotonic()
+        with ThreadPoolExecutor(concurrency) as executor:
+            results = list(executor.map(
+                lambda submission: grade_submission(
+                    portal, submission[0], submission[2], timeout),
+                submissions,
+            ))
+        elapsed = time.monotonic() - start
+    finally:
+        portal.stop()
+
+    latencies = [latency for _, latency in results]
+    breakdown = collections.Counter()
+    scores = collections.defaultdict(list)
+    for (submission_id, kind, _), (returncode, _) in zip(submissions, results):
+        status, score = portal.final_status(submission_id)
+        breakdown[
+            f"{kind}: {status or 'no-status'} score {score} (exit {returncode})"
+        ] += 1
+        # Multipart posts send the score as text
+        scores[kind].append(None if score is None else float(score))
+
+    # Failing submissions are only meaningful if they lose points against
+    # the untouched ones
+    baseline = min(
+        (score for score in scores["ok"] if score is not None), default=None)
+    below_baseline = sum(
+        1 for score in scores["failing"]
+        if score is not None and baseline is not None and score < baseline
+    )
+
+    return {
+        "submissions": count,
+        "concurrency": concurrency,
+        "elapsed": elapsed,
+        "throughput_per_minute": 60 * count / elapsed,
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies),
+        },
+        "breakdown": dict(sorted(breakdown.items())),
+        "failing": {
+            "submissions": len(scores["failing"]),
+            "baseline_score": baseline,
+            "below_baseline": below_baseline,
+        },
+    }
@@ -0,0 +1,56 @@
+import threading
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class MemorySampler:
+    """
+    Sample the resident memory of a process and its children in a background
+    thread, keeping the peak and the delta between start and stop
+    """
+
+    def __init__(self, pid, interval=0.05):
+        if psutil is None:
+            raise RuntimeError(
+                "Memory profiling requires psutil, install ldsagrader[memory]")
+
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.start_rss = 0
+        self.end_rss = 0
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def rss(self):
+        try:
+            processes = [self.process] + self.process.children(recursive=True)
+            return sum(process.memory_info().rss for process in processes)
+        except psutil.Error:
+            # Kernel died or a child exited mid-sample
+            return 0
+
+    def _sample(self):
+        rss = self.rss()
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self.start_rss = self._sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.end_rss = self._sample()
+
+    @property
+    def delta_rss(self):
+        return self.end_rss - self.start_rss
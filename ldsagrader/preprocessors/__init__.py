@@ -1 +1,2 @@
 from .forbidhiddentests import ForbidHiddenTests
+from .partialexecute import PartialExecute
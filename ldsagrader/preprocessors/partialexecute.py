@@ -0,0 +1,104 @@
+from nbclient.exceptions import CellTimeoutError, DeadKernelError
+from nbconvert.preprocessors import ExecutePreprocessor
+from nbformat.v4 import new_output
+from traitlets import Any, Bool, Float
+
+from ..memory import MemorySampler
+from ..utils import drop_memory_profile
+
+
+class PartialExecute(ExecutePreprocessor):
+    """
+    Execute notebook keeping the state up to the cell that timed out or
+    killed the kernel, remaining code cells are marked as not executed
+    """
+
+    profile_memory = Bool(
+        False, help="Record peak and delta kernel memory of each code cell"
+    ).tag(config=True)
+
+    memory_interval = Float(
+        0.05, help="Seconds between kernel memory samples"
+    ).tag(config=True)
+
+    cell_callback = Any(
+        None,
+        allow_none=True,
+        help="Called with (cell, index) as soon as each cell finishes executing",
+    ).tag(config=True)
+
+    def preprocess(self, nb, resources=None, km=None):
+        self.interrupted = None
+        # Only keep the profile of this run
+        drop_memory_profile(nb)
+        if self.profile_memory:
+            nb.metadata.setdefault("ldsagrader", {})["memory"] = []
+        nb, resources = super().preprocess(nb, resources, km)
+        if self.interrupted:
+            # The output poll of the interrupted cell can still append to it
+            # (e.g. a KeyboardInterrupt) until the kernel is shut down
+            self._mark_not_executed(nb.cells[resources["interrupted"]["cell_index"]])
+        return nb, resources
+
+    def _kernel_pid(self):
+        kernel = getattr(self.km, "kernel", None)
+        if kernel is None:
+            # jupyter_client >= 7 keeps the process in the provisioner
+            kernel = self.km.provisioner.process
+        return kernel.pid
+
+    def _record_memory(self, cell, index, sampler):
+        grade_id = cell.metadata.get("nbgrader", {}).get("grade_id")
+        ldsagrader = self.nb.metadata.setdefault("ldsagrader", {})
+        ldsagrader.setdefault("memory", []).append(
+            {
+                "cell_index": index,
+                "grade_id": grade_id,
+                "peak_rss": sampler.peak_rss,
+                "delta_rss": sampler.delta_rss,
+            }
+        )
+
+    def _mark_not_executed(self, cell):
+        if cell.cell_type != "code":
+            return
+
+        cell.outputs = [
+            new_output(
+                "error",
+                ename="NotExecuted",
+                evalue=self.interrupted,
+                traceback=[f"Cell not executed: {self.interrupted}"],
+            )
+        ]
+
+    def preprocess_cell(self, cell, resources, index, **kwargs):
+        if self.interrupted:
+            self._mark_not_executed(cell)
+            return cell, resources
+
+        sampler = None
+        if self.profile_memory and cell.cell_type == "code":
+            sampler = MemorySampler(self._kernel_pid(), self.memory_interval)
+            sampler.start()
+
+        try:
+            cell, resources = super().preprocess_cell(cell, resources, index, **kwargs)
+            if self.cell_callback:
+                self.cell_callback(cell, index)
+            return cell, resources
+
+        except CellTimeoutError:
+            self.interrupted = "Cell execution timed out"
+
+        except DeadKernelError:
+            self.interrupted = "Kernel died"
+
+        finally:
+            if sampler:
+                sampler.stop()
+                self._record_memory(cell, index, sampler)
+
+        self._mark_not_executed(cell)
+        resources["interrupted"] = {"reason": self.interrupted, "cell_index": index}
+        return cell, resources
@@ -0,0 +1,84 @@
+import threading
+
+import requests
+from nbgrader import utils
+
+
+class ProgressReporter:
+    """
+    Post grading progress to the portal from a background thread
+
+    cell_executed is called by the executor after each cell and only updates
+    the running totals, at most one update every `interval` seconds is sent
+    with the latest totals, so the kernel never waits on the portal.
+    """
+
+    def __init__(self, grading_url, token, cells_total, interval=5.0):
+        self.grading_url = grading_url
+        self.token = token
+        self.interval = interval
+        self.cells_total = cells_total
+        self.cells_done = 0
+        self.score = 0
+        self.max_score = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def cell_executed(self, cell, index):
+        score, max_score = 0, 0
+        if utils.is_grade(cell):
+            score, max_score = utils.determine_grade(cell)
+
+        with self._lock:
+            self.cells_done = index + 1
+            self.score += score or 0
+            self.max_score += max_score
+        self._changed.set()
+
+    def _post(self):
+        with self._lock:
+            progress = {
+                "cells_done": self.cells_done,
+                "cells_total": self.cells_total,
+                "score": self.score,
+                "max_score": self.max_score,
+            }
+
+        try:
+            response = requests.patch(
+                self.grading_url,
+                headers={"Authorization": f"Token {self.token}"},
+                json={
+                    "status": "grading",
+                    "message": "Executed {cells_done}/{cells_total} cells, "
+                    "score so far {score}/{max_score}".format(**progress),
+                    "progress": progress,
+                },
+                timeout=self.interval,
+            )
+            response.raise_for_status()
+        except requests.RequestException as exc:
+            print(f"Progress update failed: {exc}")
+
+    def _run(self):
+        while True:
+            self._changed.wait()
+            if self._stop.is_set():
+                return
+
+            self._changed.clear()
+            self._post()
+            # Throttle, updates in the meantime are coalesced into the next one
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._changed.set()
+        self._thread.join()
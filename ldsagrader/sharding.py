@@ -0,0 +1,140 @@
+import hashlib
+import os
+import threading
+import time
+from urllib.parse import quote
+
+
+def parse_shard(value):
+    """
+    Parse a `i/n` shard spec, shards are numbered from 0 to n - 1
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard {value}, expected i/n")
+
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {value}, expected 0 <= i < n")
+
+    return index, count
+
+
+def shard_of(key, count):
+    """
+    Rendezvous (highest random weight) hashing, when the number of shards
+    changes only the keys of the added or removed shards move
+    """
+
+    def weight(shard):
+        digest = hashlib.sha256(f"{shard}:{key}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    return max(range(count), key=weight)
+
+
+class LeaseDirectory:
+    """
+    Work leases shared between nodes as files in a directory
+
+    A lease is a `<key>.lease` file created exclusively by the node working
+    on the key and kept fresh by a heartbeat, finished keys get a `.done`
+    file. A lease not refreshed for `ttl` seconds belongs to a crashed node
+    and can be reclaimed.
+    """
+
+    def __init__(self, path, node, ttl=600):
+        self.path = path
+        self.node = node
+        self.ttl = ttl
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key, suffix):
+        return os.path.join(self.path, quote(key, safe="") + suffix)
+
+    def _expired(self, path):
+        return time.time() - os.stat(path).st_mtime > self.ttl
+
+    def is_done(self, key):
+        return os.path.exists(self._file(key, ".done"))
+
+    def is_leased(self, key):
+        try:
+            return not self._expired(self._file(key, ".lease"))
+        except FileNotFoundError:
+            return False
+
+    def acquire(self, key):
+        if self.is_done(key):
+            return False
+
+        path = self._file(key, ".lease")
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return self._reclaim(key, path)
+
+        with os.fdopen(fd, "w") as fp:
+            fp.write(self.node)
+        # The holder may have released it as done between our check and create
+        if self.is_done(key):
+            os.remove(path)
+            return False
+
+        with self._lock:
+            self._held.add(key)
+        return True
+
+    def _reclaim(self, key, path):
+        try:
+            if not self._expired(path):
+                return False
+            # Only one node can move the expired lease aside
+            stale = f"{path}.{quote(self.node, safe='')}.stale"
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return False
+
+        if not self._expired(stale):
+            # Another node reclaimed it first, put its fresh lease back
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+
+        os.remove(stale)
+        return self.acquire(key)
+
+    def release(self, key, done=True):
+        with self._lock:
+            self._held.discard(key)
+        if done:
+            open(self._file(key, ".done"), "w").close()
+        try:
+            os.remove(self._file(key, ".lease"))
+        except FileNotFoundError:
+            pass
+
+    def _renew(self):
+        while not self._stop.wait(self.ttl / 3):
+            with self._lock:
+                held = list(self._held)
+            for key in held:
+                try:
+                    os.utime(self._file(key, ".lease"))
+                except FileNotFoundError:
+                    pass
+
+    def __enter__(self):
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._heartbeat.join()
@@ -1,5 +1,8 @@
+import functools
 import hashlib
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 
 import nbformat
 import nbconvert
@@ -7,6 +10,28 @@ from nbgrader import utils
 from traitlets.config import Config
 
 
+class ExecutionInterrupted(RuntimeError):
+    """
+    Execution stopped before the end of the notebook, holds the notebook
+    executed up to the cell where it stopped
+    """
+
+    def __init__(self, notebook, reason, cell_index):
+        self.notebook = notebook
+        self.reason = reason
+        self.cell_index = cell_index
+        super().__init__(f"{reason} ({self.cell_name})")
+
+    @property
+    def cell_name(self):
+        """
+        Grade id of the cell where execution stopped, or its 1-based position
+        """
+        cell = self.notebook.cells[self.cell_index]
+        grade_id = cell.metadata.get("nbgrader", {}).get("grade_id")
+        return grade_id or f"cell {self.cell_index + 1}"
+
+
 def find_path(codename):
     for root, dirs, files in os.walk(".", topdown=False):
         for dir_ in dirs:
@@ -21,6 +46,30 @@ def find_exercise_nb(codename):
     return os.path.join(path, "Exercise notebook.ipynb")
 
 
+def find_exercise_nbs():
+    """
+    Find every Learning Unit exercise notebook in a single walk, the codename
+    is the leading alphanumeric part of the Learning Unit directory name
+    (e.g. SLU01 for "SLU01 - Intro" or "SLU01-Intro")
+    """
+    units = {}
+    for root, dirs, files in os.walk("."):
+        if "Exercise notebook.ipynb" in files:
+            match = re.match(r"[A-Za-z0-9]+", os.path.basename(root))
+            if not match:
+                raise RuntimeError(f"No codename in Learning Unit directory {root}")
+
+            codename = match.group()
+            path = os.path.join(root, "Exercise notebook.ipynb")
+            duplicate = units.get(codename.lower())
+            if duplicate:
+                raise RuntimeError(
+                    f"Codename {codename} used by {duplicate[1]} and {path}")
+            units[codename.lower()] = (codename, path)
+
+    return dict(sorted(units.values()))
+
+
 def calculate_checksum(nb):
     m = hashlib.sha256()
     for cell in nb.cells:
@@ -33,6 +82,26 @@ def calculate_checksum(nb):
     return m.hexdigest()
 
 
+def calculate_file_checksum(path, cache=None):
+    if cache:
+        nb = cache.read(path)
+    else:
+        nb = nbformat.read(path, as_version=nbformat.NO_CONVERT)
+    return calculate_checksum(nb)
+
+
+def calculate_file_checksums(paths, workers=None, cache=None):
+    """
+    Checksum notebook files in parallel, returns a dict of path to checksum
+    """
+    if len(paths) == 1:
+        return {paths[0]: calculate_file_checksum(paths[0], cache)}
+
+    checksum = functools.partial(calculate_file_checksum, cache=cache)
+    with ProcessPoolExecutor(workers) as executor:
+        return dict(zip(paths, executor.map(checksum, paths)))
+
+
 def grade(nb):
     total_score = 0
     max_total_score = 0
@@ -49,20 +118,53 @@ def is_valid(nb, checksum):
     return calculate_checksum(nb) == checksum
 
 
-def execute(notebook, timeout=None, allow_errors=True):
+def execute(
+    notebook,
+    timeout=None,
+    allow_errors=True,
+    cwd=None,
+    profile_memory=False,
+    cell_callback=None,
+):
     c = Config()
     c.NotebookExporter.preprocessors = [
         "nbconvert.preprocessors.ClearOutputPreprocessor",
-        "nbconvert.preprocessors.ExecutePreprocessor",
+        "ldsagrader.preprocessors.PartialExecute",
     ]
     c.ExecutePreprocessor.allow_errors = allow_errors
     if timeout:
         c.ExecutePreprocessor.timeout = timeout
+    c.PartialExecute.profile_memory = profile_memory
+    if cell_callback:
+        # Config values are deep copied, functions are not but bound methods are
+        c.PartialExecute.cell_callback = lambda cell, index: cell_callback(cell, index)
 
     exporter = nbconvert.NotebookExporter(config=c)
-    notebook, _ = exporter.from_notebook_node(notebook)
+    # Run the kernel in the notebook directory without touching the process cwd
+    resources = {"metadata": {"path": cwd}} if cwd else None
+    notebook, resources = exporter.from_notebook_node(notebook, resources)
+    notebook = nbformat.reads(notebook, as_version=nbformat.NO_CONVERT)
+
+    interrupted = resources.get("interrupted")
+    if interrupted:
+        raise ExecutionInterrupted(
+            notebook, interrupted["reason"], interrupted["cell_index"])
+
+    return notebook
+
+
+def memory_profile(notebook):
+    """
+    Per cell kernel memory recorded by execute(..., profile_memory=True)
+    """
+    return notebook.metadata.get("ldsagrader", {}).get("memory", [])
+
 
-    return nbformat.reads(notebook, as_version=nbformat.NO_CONVERT)
+def drop_memory_profile(notebook):
+    ldsagrader = notebook.metadata.get("ldsagrader", {})
+    ldsagrader.pop("memory", None)
+    if not ldsagrader:
+        notebook.metadata.pop("ldsagrader", None)
 
 
 def clear(notebook, allow_hidden_tests=False):
@@ -78,5 +180,7 @@ def clear(notebook, allow_hidden_tests=False):
 
     exporter = nbconvert.NotebookExporter(config=c)
     notebook, _ = exporter.from_notebook_node(notebook)
+    notebook = nbformat.reads(notebook, as_version=nbformat.NO_CONVERT)
+    drop_memory_profile(notebook)
 
-    return nbformat.reads(notebook, as_version=nbformat.NO_CONVERT)
+    return notebook
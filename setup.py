@@ -19,6 +19,11 @@ requirements = [
     "Jinja2==3.0.0",
 ]
 
+extra_requirements = {
+    "memory": ["psutil"],
+    "archive": ["zstandard"],
+}
+
 setup_requirements = [
     "pytest-runner",
 ]
@@ -48,6 +53,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="MIT license",
     long_description=readme + "\n\n" + history,
     include_package_data=True,
@@ -0,0 +1,91 @@
+import json
+import os
+
+import nbformat
+from nbformat.v4 import new_code_cell, new_markdown_cell, new_notebook, new_output
+
+from ldsagrader import archive
+
+
+TEMPLATE = new_notebook(
+    cells=[
+        new_markdown_cell("# Instructions\n" + "Read carefully. " * 50),
+        new_code_cell(
+            "import this\n" * 20,
+            outputs=[new_output("stream", text="The Zen of Python\n" * 20)],
+        ),
+        new_code_cell(),
+    ]
+)
+
+
+def make_notebook(answer):
+    """
+    A submission of TEMPLATE, sharing its cell ids like real ones do
+    """
+    notebook = nbformat.from_dict(TEMPLATE)
+    notebook.cells[2].source = f"answer = {answer}"
+    notebook.cells[1].metadata["execution"] = {
+        "iopub.execute_input": f"2024-01-0{answer}T00:00:00.000000Z",
+    }
+    return notebook
+
+
+def object_count(directory):
+    return sum(
+        len(files) for _, _, files in os.walk(os.path.join(directory, "objects")))
+
+
+def test_put_get_is_byte_for_byte(tmp_path):
+    store = archive.Archive(str(tmp_path))
+    data = archive.serialize(make_notebook(1))
+
+    digest = store.put("SLU01/student", data)
+
+    assert "raw" not in json.loads(store._load(digest))
+    assert store.get("SLU01/student") == data
+    assert store.get("SLU01/student", digest) == data
+
+
+def test_shared_cells_are_stored_once(tmp_path):
+    store = archive.Archive(str(tmp_path))
+    store.put("SLU01/a", archive.serialize(make_notebook(1)))
+    objects = object_count(str(tmp_path))
+
+    data = archive.serialize(make_notebook(2))
+    store.put("SLU01/b", data)
+
+    # Only the new manifest, the large cells are shared despite timings
+    assert object_count(str(tmp_path)) == objects + 1
+    assert store.get("SLU01/b") == data
+
+
+def test_history_keeps_every_put(tmp_path):
+    store = archive.Archive(str(tmp_path))
+    first = archive.serialize(make_notebook(1))
+    second = archive.serialize(make_notebook(2))
+    digest = store.put("SLU01/student", first)
+    store.put("SLU01/student", second)
+
+    assert [d for _, d in store.history("SLU01/student")][0] == digest
+    assert store.get("SLU01/student") == second
+    assert store.get("SLU01/student", digest) == first
+
+
+def test_non_canonical_notebook_is_stored_raw(tmp_path):
+    store = archive.Archive(str(tmp_path))
+    data = json.dumps(make_notebook(1), indent=4).encode("utf-8")
+
+    digest = store.put("SLU01/student", data)
+
+    assert "raw" in json.loads(store._load(digest))
+    assert store.get("SLU01/student") == data
+
+
+def test_gzip_objects_are_readable(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "zstandard", None)
+    store = archive.Archive(str(tmp_path))
+    data = archive.serialize(make_notebook(1))
+    store.put("SLU01/student", data)
+
+    assert store.get("SLU01/student") == data
@@ -0,0 +1,120 @@
+import os
+import time
+
+import pytest
+
+from ldsagrader import sharding
+
+
+def test_parse_shard():
+    assert sharding.parse_shard("0/1") == (0, 1)
+    assert sharding.parse_shard("2/3") == (2, 3)
+
+
+@pytest.mark.parametrize("value", ["", "1", "a/b", "3/3", "-1/2", "0/0"])
+def test_parse_shard_invalid(value):
+    with pytest.raises(ValueError):
+        sharding.parse_shard(value)
+
+
+def test_shard_of_is_deterministic_and_in_range():
+    keys = [f"user{i}/SLU{i % 7:02d}" for i in range(200)]
+    shards = [sharding.shard_of(key, 4) for key in keys]
+    assert shards == [sharding.shard_of(key, 4) for key in keys]
+    assert set(shards) == {0, 1, 2, 3}
+
+
+def test_shard_of_only_moves_keys_to_added_shard():
+    keys = [f"user{i}/SLU01" for i in range(200)]
+    for key in keys:
+        before, after = sharding.shard_of(key, 4), sharding.shard_of(key, 5)
+        assert after in (before, 4)
+
+
+def make_leases(tmp_path, node, ttl=60):
+    return sharding.LeaseDirectory(str(tmp_path), node, ttl)
+
+
+def expire(leases, key):
+    past = time.time() - leases.ttl - 1
+    os.utime(leases._file(key, ".lease"), (past, past))
+
+
+def test_lease_is_exclusive(tmp_path):
+    a, b = make_leases(tmp_path, "a"), make_leases(tmp_path, "b")
+    assert a.acquire("job")
+    assert not b.acquire("job")
+    assert b.is_leased("job")
+
+
+def test_released_lease_is_done(tmp_path):
+    a, b = make_leases(tmp_path, "a"), make_leases(tmp_path, "b")
+    assert a.acquire("job")
+    a.release("job")
+    assert a.is_done("job")
+    assert not b.acquire("job")
+
+
+def test_lease_released_during_acquire_is_done(tmp_path):
+    # The holder releases the job between our done check and lease create
+    a, b = make_leases(tmp_path, "a"), make_leases(tmp_path, "b")
+    assert a.acquire("job")
+    real_is_done = b.is_done
+    checks = []
+
+    def is_done(key):
+        checks.append(key)
+        if len(checks) == 1:
+            a.release(key)
+            return False
+        return real_is_done(key)
+
+    b.is_done = is_done
+    assert not b.acquire("job")
+    assert not b.is_leased("job")
+    assert "job" not in b._held
+
+
+def test_failed_lease_can_be_retried(tmp_path):
+    a, b = make_leases(tmp_path, "a"), make_leases(tmp_path, "b")
+    assert a.acquire("job")
+    a.release("job", done=False)
+    assert not a.is_done("job")
+    assert b.acquire("job")
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    a, b = make_leases(tmp_path, "a"), make_leases(tmp_path, "b")
+    assert a.acquire("job")
+    expire(a, "job")
+    assert not b.is_leased("job")
+    assert b.acquire("job")
+    with open(b._file("job", ".lease")) as fp:
+        assert fp.read() == "b"
+    assert not a.acquire("job")
+
+
+def test_reclaim_keeps_fresh_lease_moved_aside(tmp_path):
+    # Another node reclaimed the lease between our expiry check and rename
+    a = make_leases(tmp_path, "a")
+    assert a.acquire("job")
+    path = a._file("job", ".lease")
+    real_expired = a._expired
+    checks = []
+
+    def expired(p):
+        checks.append(p)
+        return len(checks) == 1 or real_expired(p)
+
+    a._expired = expired
+    assert not a._reclaim("job", path)
+    assert os.path.exists(path)
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".stale")] == []
+
+
+def test_heartbeat_keeps_lease_fresh(tmp_path):
+    with make_leases(tmp_path, "a", ttl=0.3) as a:
+        assert a.acquire("job")
+        time.sleep(0.6)
+        assert a.is_leased("job")
+        assert not make_leases(tmp_path, "b", ttl=0.3).acquire("job")